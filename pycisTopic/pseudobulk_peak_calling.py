@@ -1,20 +1,37 @@
+import csv
 import gc
+import io
 import logging
 import os
 import re
+import shutil
 import subprocess
 import sys
-from typing import Dict, List, Optional, Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 
 import numpy as np
 import pandas as pd
 import pyBigWig
 import pyranges as pr
 import ray
+from pandas.api.types import union_categoricals
 
 from .cistopic_class import *
 from .utils import *
 
+log = logging.getLogger("cisTopic")
+
+
+def _configure_logging():
+    """
+    Log to stdout. Does nothing if logging is already configured (e.g. in a reused ray worker process).
+    """
+    level = logging.INFO
+    log_format = "%(asctime)s %(name)-12s %(levelname)-8s %(message)s"
+    handlers = [logging.StreamHandler(stream=sys.stdout)]
+    logging.basicConfig(level=level, format=log_format, handlers=handlers)
+
 
 def export_pseudobulk(
     input_data: Union["CistopicObject", pd.DataFrame, Dict[str, pd.DataFrame]],
@@ -29,6 +46,7 @@ def export_pseudobulk(
     remove_duplicates: Optional[bool] = True,
     split_pattern: Optional[str] = "___",
     use_polars: Optional[bool] = True,
+    chromosome_split_threshold: Optional[int] = 5000000,
     **kwargs
 ):
     """
@@ -67,8 +85,12 @@ def export_pseudobulk(
             Pattern to split cell barcode from sample id. Default: ___ .
     use_polars: bool, optional
             Whether to use polars to read fragments files. Default: True.
+    chromosome_split_threshold: int, optional
+            Groups with more fragments than this number get the coverage of each chromosome computed in a separate ray
+            task for their bigwig file, so large groups do not delay the whole run. Only used if n_cpu > 1. Default: 5000000.
     **kwargs
-            Additional parameters for ray.init()
+            Additional parameters for ray.init(). If Ray is already initialized (e.g. when the whole pipeline is wrapped in a
+            single ray.init() call by the user), the running Ray instance is used and it will not be shut down.
 
     Return
     ------
@@ -76,12 +98,7 @@ def export_pseudobulk(
             A dictionary containing the paths to the newly created bed fragments files per group a dictionary containing the paths to the
             newly created bigwig files per group.
     """
-    # Create logger
-    level = logging.INFO
-    log_format = "%(asctime)s %(name)-12s %(levelname)-8s %(message)s"
-    handlers = [logging.StreamHandler(stream=sys.stdout)]
-    logging.basicConfig(level=level, format=log_format, handlers=handlers)
-    log = logging.getLogger("cisTopic")
+    _configure_logging()
 
     # Get fragments file
     if isinstance(input_data, CistopicObject):
@@ -101,8 +118,19 @@ def export_pseudobulk(
             'Please, include a sample identification column (e.g. "sample_id") in your cell metadata!'
         )
 
+    # Set groups
+    if "barcode" in cell_data:
+        cell_data = cell_data.loc[:, [variable, sample_id_col, "barcode"]]
+    else:
+        cell_data = cell_data.loc[:, [variable, sample_id_col]]
+        # Get the barcode of each cell in the fragments files once.
+        cell_data["barcode"] = prepare_tag_cells(cell_data.index, split_pattern)
+    cell_data[variable] = cell_data[variable].replace(" ", "", regex=True)
+    cell_data[variable] = cell_data[variable].replace("[^A-Za-z0-9]+", "_", regex=True)
+    groups = sorted(list(set(cell_data[variable])))
+
     # Get fragments
-    fragments_df_dict = {}
+    sample_data_dict = {}
     for sample_id in path_to_fragments.keys():
         if sample_id not in sample_ids:
             log.info(
@@ -111,49 +139,99 @@ def export_pseudobulk(
                 ". It will be ignored.",
             )
         else:
-            log.info("Reading fragments from " + path_to_fragments[sample_id])
-            fragments_df = read_fragments_from_file(path_to_fragments[sample_id], use_polars=use_polars).df
-            # Convert to int32 for memory efficiency
-            fragments_df.Start = np.int32(fragments_df.Start)
-            fragments_df.End = np.int32(fragments_df.End)
-            if "Score" in fragments_df:
-                fragments_df.Score = np.int32(fragments_df.Score)
-            if "barcode" in cell_data:
-                fragments_df = fragments_df.loc[
-                    fragments_df["Name"].isin(cell_data["barcode"].tolist())
-                ]
-            else:
-                fragments_df = fragments_df.loc[
-                    fragments_df["Name"].isin(
-                        prepare_tag_cells(cell_data.index.tolist(), split_pattern)
-                    )
-                ]
-            fragments_df_dict[sample_id] = fragments_df
-
-    # Set groups
-    if "barcode" in cell_data:
-        cell_data = cell_data.loc[:, [variable, sample_id_col, "barcode"]]
+            sample_data_dict[sample_id] = cell_data.loc[
+                cell_data[sample_id_col] == sample_id
+            ].set_index("barcode")
+    # Only the barcodes of the cells of each sample are kept from its fragments file.
+    if n_cpu > 1:
+        # Reuse a running Ray instance and only shut down the one started here.
+        owns_ray = not ray.is_initialized()
+        if owns_ray:
+            ray.init(num_cpus=n_cpu, **kwargs)
+        fragments_df_list = ray.get(
+            [
+                read_sample_fragments_ray.remote(
+                    path_to_fragments[sample_id],
+                    sample_data_dict[sample_id].index,
+                    use_polars,
+                )
+                for sample_id in sample_data_dict
+            ]
+        )
     else:
-        cell_data = cell_data.loc[:, [variable, sample_id_col]]
-    cell_data[variable] = cell_data[variable].replace(" ", "", regex=True)
-    cell_data[variable] = cell_data[variable].replace("[^A-Za-z0-9]+", "_", regex=True)
-    groups = sorted(list(set(cell_data[variable])))
+        fragments_df_list = [
+            read_sample_fragments(
+                path_to_fragments[sample_id],
+                sample_data_dict[sample_id].index,
+                use_polars,
+            )
+            for sample_id in sample_data_dict
+        ]
+    fragments_df_dict = dict(zip(sample_data_dict.keys(), fragments_df_list))
+    del fragments_df_list
+
+    # Assign fragments to their group once, instead of scanning all fragments for each group
+    for sample_id, fragments_df in fragments_df_dict.items():
+        fragments_df["Group"] = fragments_df["Name"].map(
+            sample_data_dict[sample_id].loc[:, variable]
+        )
+    del sample_data_dict
+    # Merge fragments of all samples at once.
+    fragments_df = pd.concat(
+        list(fragments_df_dict.values()), ignore_index=True, copy=False
+    )
+    # Keep chromosomes and barcodes as pd.Categorical (pd.concat only keeps them when all samples have the
+    # same categories), so each barcode is only stored (and serialized by Ray) once.
+    fragments_df["Chromosome"] = union_categoricals(
+        [
+            sample_fragments["Chromosome"].astype("category")
+            for sample_fragments in fragments_df_dict.values()
+        ],
+        sort_categories=True,
+    )
+    fragments_df["Name"] = union_categoricals(
+        [
+            sample_fragments["Name"].astype("category")
+            for sample_fragments in fragments_df_dict.values()
+        ]
+    )
+    del fragments_df_dict
+    gc.collect()
+    # Sort all fragments once, so the fragments of each group are sorted as well
+    fragments_df.sort_values(
+        ["Chromosome", "Start"], kind="stable", ignore_index=True, inplace=True
+    )
+    group_indices = fragments_df.groupby("Group", sort=False).indices
+    del fragments_df["Group"]
+    group_fragments_dict = {}
+    for group in groups:
+        if group not in group_indices:
+            log.info("No fragments found for " + str(group) + ". It will be ignored.")
+        else:
+            group_fragments = fragments_df.take(group_indices[group])
+            group_fragments["Name"] = group_fragments[
+                "Name"
+            ].cat.remove_unused_categories()
+            group_fragments_dict[group] = group_fragments
+            del group_fragments
+    del fragments_df
+    del group_indices
+    gc.collect()
+    groups = list(group_fragments_dict.keys())
     # Check chromosome sizes
     if isinstance(chromsizes, pd.DataFrame):
         chromsizes = chromsizes.loc[:, ["Chromosome", "Start", "End"]]
         chromsizes = pr.PyRanges(chromsizes)
     # Check that output dir exist and generate output paths
     if isinstance(bed_path, str):
-        if not os.path.exists(bed_path):
-            os.makedirs(bed_path)
+        os.makedirs(bed_path, exist_ok=True)
         bed_paths = {
             group: os.path.join(bed_path, str(group) + ".bed.gz") for group in groups
         }
     else:
         bed_paths = {}
     if isinstance(bigwig_path, str):
-        if not os.path.exists(bigwig_path):
-            os.makedirs(bigwig_path)
+        os.makedirs(bigwig_path, exist_ok=True)
         bw_paths = {
             group: os.path.join(bigwig_path, str(group) + ".bw") for group in groups
         }
@@ -161,198 +239,588 @@ def export_pseudobulk(
         bw_paths = {}
     # Create pseudobulks
     if n_cpu > 1:
-        ray.init(num_cpus=n_cpu, **kwargs)
-        ray_handle = ray.wait(
+        # Put data shared by all groups once in the object store, instead of serializing it for each group.
+        chromsizes_ref = ray.put(chromsizes)
+        # Bigwig files of groups with many fragments are created from the coverage of each chromosome.
+        split_groups = [
+            group
+            for group in groups
+            if group in bw_paths
+            and len(group_fragments_dict[group]) > chromosome_split_threshold
+        ]
+        split_bigwig_refs = [
+            fragments_to_bigwig_by_chromosome(
+                group_fragments_dict[group],
+                chromsizes,
+                bw_paths[group],
+                normalize_bigwig,
+                remove_duplicates,
+            )
+            for group in split_groups
+        ]
+        # Groups of which the bigwig file is created per chromosome only need a task for their bed file.
+        task_groups = [
+            group for group in groups if group not in split_groups or group in bed_paths
+        ]
+        task_results = ray.get(
             [
                 export_pseudobulk_ray.remote(
-                    cell_data,
+                    group_fragments_dict[group],
                     group,
-                    fragments_df_dict,
-                    chromsizes,
-                    bigwig_path,
-                    bed_path,
-                    sample_id_col,
+                    chromsizes_ref,
+                    None if group in split_groups else bw_paths.get(group),
+                    bed_paths.get(group),
                     normalize_bigwig,
                     remove_duplicates,
-                    split_pattern,
                 )
-                for group in groups
-            ],
-            num_returns=len(groups),
+                for group in task_groups
+            ]
         )
-        ray.shutdown()
+        task_results = dict(zip(task_groups, task_results))
+        split_bw_paths = dict(zip(split_groups, ray.get(split_bigwig_refs)))
+        results = []
+        for group in groups:
+            _, bw_path_group, bed_path_group = task_results.get(
+                group, (group, None, None)
+            )
+            results.append(
+                (group, split_bw_paths.get(group, bw_path_group), bed_path_group)
+            )
+        if owns_ray:
+            ray.shutdown()
     else:
-        [
+        results = [
             export_pseudobulk_one_sample(
-                cell_data,
+                group_fragments_dict[group],
                 group,
-                fragments_df_dict,
                 chromsizes,
-                bigwig_path,
-                bed_path,
-                sample_id_col,
+                bw_paths.get(group),
+                bed_paths.get(group),
                 normalize_bigwig,
                 remove_duplicates,
-                split_pattern,
             )
             for group in groups
         ]
+    bw_paths = {
+        group: bw_path_group
+        for group, bw_path_group, _ in results
+        if bw_path_group is not None
+    }
+    bed_paths = {
+        group: bed_path_group
+        for group, _, bed_path_group in results
+        if bed_path_group is not None
+    }
 
     return bw_paths, bed_paths
 
 
+def read_sample_fragments(
+    path_to_fragments: str,
+    cell_barcodes: Union[List[str], pd.Index],
+    use_polars: Optional[bool] = True,
+):
+    """
+    Read fragments of the given cell barcodes from a fragments file.
+
+    Parameters
+    ---------
+    path_to_fragments: str
+            Path to the fragments file of the sample.
+    cell_barcodes: list or pd.Index
+            Cell barcodes for which fragments have to be kept.
+    use_polars: bool, optional
+            Whether to use polars to read fragments files. Default: True.
+
+    Return
+    ------
+    pd.DataFrame
+            A data frame with 'Chromosome', 'Start', 'End', 'Name', and 'Score' as columns.
+    """
+    log.info("Reading fragments from " + path_to_fragments)
+    # Only keep fragments of annotated cells while reading the fragments file.
+    fragments_df = read_fragments_from_file(
+        path_to_fragments,
+        use_polars=use_polars,
+        cell_barcodes=cell_barcodes,
+    ).df
+    # Start, End and Score are read as int32 for memory efficiency, but PyRanges (>= 0.1) casts Start and End to int64.
+    for column in ("Start", "End"):
+        if fragments_df[column].dtype != np.int32:
+            fragments_df[column] = fragments_df[column].astype(np.int32)
+    return fragments_df
+
+
+@ray.remote
+def read_sample_fragments_ray(
+    path_to_fragments: str,
+    cell_barcodes: Union[List[str], pd.Index],
+    use_polars: Optional[bool] = True,
+):
+    """
+    Read fragments of the given cell barcodes from a fragments file.
+
+    Parameters
+    ---------
+    path_to_fragments: str
+            Path to the fragments file of the sample.
+    cell_barcodes: list or pd.Index
+            Cell barcodes for which fragments have to be kept.
+    use_polars: bool, optional
+            Whether to use polars to read fragments files. Default: True.
+
+    Return
+    ------
+    pd.DataFrame
+            A data frame with 'Chromosome', 'Start', 'End', 'Name', and 'Score' as columns.
+    """
+    _configure_logging()
+    return read_sample_fragments(path_to_fragments, cell_barcodes, use_polars)
+
+
 def export_pseudobulk_one_sample(
-    cell_data: pd.DataFrame,
+    group_fragments: pd.DataFrame,
     group: str,
-    fragments_df_dict: Dict[str, pd.DataFrame],
     chromsizes: pr.PyRanges,
-    bigwig_path: str,
-    bed_path: str,
-    sample_id_col: Optional[str] = "sample_id",
+    bigwig_path_group: Optional[str],
+    bed_path_group: Optional[str],
     normalize_bigwig: Optional[bool] = True,
     remove_duplicates: Optional[bool] = True,
-    split_pattern: Optional[str] = "___",
 ):
     """
-    Create pseudobulk as bed and bigwig from single cell fragments file given a barcode annotation and a group.
+    Create pseudobulk as bed and bigwig from the single cell fragments of a group.
 
     Parameters
     ---------
-    cell_data: pd.DataFrame
-            A cell metadata :class:`pd.Dataframe` containing barcodes, their annotation and their sample of origin.
+    group_fragments: pd.DataFrame
+            A data frame with 'Chromosome', 'Start', 'End', 'Name', and 'Score' as columns, containing the fragments of the cells
+            in the group. 'Score' indicates the number of times that a fragments is found assigned to that barcode.
     group: str
             A character string indicating the group for which pseudobulks will be created.
-    fragments_df_dict: dict
-            A dictionary containing data frames as values with 'Chromosome', 'Start', 'End', 'Name', and 'Score' as columns; and sample label
-            as keys. 'Score' indicates the number of times that a fragments is found assigned to that barcode.
+    chromsizes: pr.PyRanges
+            A :class:`pr.PyRanges` containing size of each column, containing 'Chromosome', 'Start' and 'End' columns.
+    bigwig_path_group: str
+            Path to the bigwig file of the group. If None, the file will not be generated.
+    bed_path_group: str
+            Path to the fragments bed file of the group. If None, the file will not be generated.
+    normalize_bigwig: bool, optional
+            Whether bigwig files should be CPM normalized. Default: True.
+    remove_duplicates: bool, optional
+            Whether duplicates should be removed before converting the data to bigwig.
+
+    Return
+    ------
+    tuple
+            The group, the path to its bigwig file and the path to its fragments bed file (None if not generated).
+    """
+    log.info("Creating pseudobulk for " + str(group))
+    if bigwig_path_group is not None:
+        fragments_to_bigwig(
+            group_fragments,
+            chromsizes,
+            bigwig_path_group,
+            normalize_bigwig,
+            remove_duplicates,
+        )
+    if bed_path_group is not None:
+        fragments_to_bed(group_fragments, bed_path_group)
+
+    log.info(str(group) + " done!")
+    return group, bigwig_path_group, bed_path_group
+
+
+def fragments_to_bigwig(
+    fragments_df: pd.DataFrame,
+    chromsizes: pr.PyRanges,
+    bigwig_path: str,
+    normalize_bigwig: Optional[bool] = True,
+    remove_duplicates: Optional[bool] = True,
+):
+    """
+    Write the coverage of fragments to a bigwig file.
+
+    Parameters
+    ---------
+    fragments_df: pd.DataFrame
+            A data frame with 'Chromosome', 'Start', 'End', and 'Score' as columns. 'Score' indicates the number of times that a
+            fragments is found assigned to that barcode.
     chromsizes: pr.PyRanges
             A :class:`pr.PyRanges` containing size of each column, containing 'Chromosome', 'Start' and 'End' columns.
     bigwig_path: str
-            Path to folder where the bigwig file will be saved.
-    bed_path: str
-            Path to folder where the fragments bed file will be saved.
-    sample_id_col: str, optional
-            Name of the column containing the sample name per barcode in the input :class:`CistopicObject.cell_data` or class:`pd.DataFrame`. Default: 'sample_id'.
+            Path to the bigwig file.
     normalize_bigwig: bool, optional
             Whether bigwig files should be CPM normalized. Default: True.
     remove_duplicates: bool, optional
             Whether duplicates should be removed before converting the data to bigwig.
-    split_pattern: str
-            Pattern to split cell barcode from sample id. Default: ___ .
     """
-    # Create logger
-    level = logging.INFO
-    log_format = "%(asctime)s %(name)-12s %(levelname)-8s %(message)s"
-    handlers = [logging.StreamHandler(stream=sys.stdout)]
-    logging.basicConfig(level=level, format=log_format, handlers=handlers)
-    log = logging.getLogger("cisTopic")
+    # Compute coverage per chromosome directly from the fragments, instead of going through PyRanges and Rle objects.
+    header, chromosome_indices, multiplier = get_bigwig_header(
+        fragments_df, chromsizes, normalize_bigwig
+    )
+    coverages = (
+        get_chromosome_coverage(
+            fragments_df.take(chromosome_indices[chromosome]), remove_duplicates
+        )
+        for chromosome, _ in header
+    )
+    coverage_to_bigwig(bigwig_path, header, coverages, multiplier)
 
-    log.info("Creating pseudobulk for " + str(group))
-    group_fragments_list = []
-    group_fragments_dict = {}
-    for sample_id in fragments_df_dict:
-        sample_data = cell_data[cell_data.loc[:, sample_id_col].isin([sample_id])]
-        if "barcode" in sample_data:
-            sample_data.index = sample_data["barcode"].tolist()
-        else:
-            sample_data.index = prepare_tag_cells(
-                sample_data.index.tolist(), split_pattern
-            )
-        group_var = sample_data.iloc[:, 0]
-        barcodes = group_var[group_var.isin([group])].index.tolist()
-        fragments_df = fragments_df_dict[sample_id]
-        group_fragments = fragments_df.loc[fragments_df["Name"].isin(barcodes)]
-        if len(fragments_df_dict) > 1:
-            group_fragments_dict[sample_id] = group_fragments
-
-    if len(fragments_df_dict) > 1:
-        group_fragments_list = [
-            group_fragments_dict[list(group_fragments_dict.keys())[x]]
-            for x in range(len(fragments_df_dict))
-        ]
-        group_fragments = group_fragments_list[0].append(group_fragments_list[1:])
 
-    del group_fragments_dict
-    del group_fragments_list
-    del fragments_df
-    gc.collect()
+def fragments_to_bigwig_by_chromosome(
+    fragments_df: pd.DataFrame,
+    chromsizes: pr.PyRanges,
+    bigwig_path: str,
+    normalize_bigwig: Optional[bool] = True,
+    remove_duplicates: Optional[bool] = True,
+):
+    """
+    Write the coverage of fragments to a bigwig file, computing the coverage of each chromosome in a separate ray task.
 
-    group_pr = pr.PyRanges(group_fragments)
-    if isinstance(bigwig_path, str):
-        bigwig_path_group = os.path.join(bigwig_path, str(group) + ".bw")
-        if remove_duplicates:
-            group_pr.to_bigwig(
-                path=bigwig_path_group,
-                chromosome_sizes=chromsizes,
-                rpm=normalize_bigwig,
+    Ray needs to be initialized.
+
+    Parameters
+    ---------
+    fragments_df: pd.DataFrame
+            A data frame with 'Chromosome', 'Start', 'End', and 'Score' as columns. 'Score' indicates the number of times that a
+            fragments is found assigned to that barcode.
+    chromsizes: pr.PyRanges
+            A :class:`pr.PyRanges` containing size of each column, containing 'Chromosome', 'Start' and 'End' columns.
+    bigwig_path: str
+            Path to the bigwig file.
+    normalize_bigwig: bool, optional
+            Whether bigwig files should be CPM normalized. Default: True.
+    remove_duplicates: bool, optional
+            Whether duplicates should be removed before converting the data to bigwig.
+
+    Return
+    ------
+    ray.ObjectRef
+            Reference to the ray task writing the bigwig file, which returns the path to the bigwig file.
+    """
+    header, chromosome_indices, multiplier = get_bigwig_header(
+        fragments_df, chromsizes, normalize_bigwig
+    )
+    coverage_refs = [
+        get_chromosome_coverage_ray.remote(
+            fragments_df.take(chromosome_indices[chromosome]), remove_duplicates
+        )
+        for chromosome, _ in header
+    ]
+    # Bigwig files are split by chromosome, so the coverage of each chromosome is added in header order.
+    return coverage_to_bigwig_ray.remote(
+        bigwig_path, header, multiplier, *coverage_refs
+    )
+
+
+def get_bigwig_header(
+    fragments_df: pd.DataFrame,
+    chromsizes: pr.PyRanges,
+    normalize_bigwig: Optional[bool] = True,
+):
+    """
+    Get the bigwig header of fragments, the fragments of each chromosome and the multiplier for coverage values.
+
+    Parameters
+    ---------
+    fragments_df: pd.DataFrame
+            A data frame with 'Chromosome', 'Start', 'End', and 'Score' as columns.
+    chromsizes: pr.PyRanges
+            A :class:`pr.PyRanges` containing size of each column, containing 'Chromosome', 'Start' and 'End' columns.
+    normalize_bigwig: bool, optional
+            Whether bigwig files should be CPM normalized. Default: True.
+
+    Return
+    ------
+    list, dict, float
+            List of (chromosome, size) tuples of the chromosomes with fragments (in the order of chromsizes), a dictionary
+            with the row positions of the fragments of each chromosome and the multiplier for coverage values.
+    """
+    size_df = chromsizes.df
+    chromosome_sizes = {k: int(v) for k, v in zip(size_df.Chromosome, size_df.End)}
+    chromosome_indices = fragments_df.groupby(
+        "Chromosome", observed=True, sort=False
+    ).indices
+    header = [
+        (chromosome, chromosome_size)
+        for chromosome, chromosome_size in chromosome_sizes.items()
+        if chromosome in chromosome_indices
+    ]
+    multiplier = 1e6 / len(fragments_df) if normalize_bigwig else 1.0
+    return header, chromosome_indices, multiplier
+
+
+def get_chromosome_coverage(
+    chromosome_fragments: pd.DataFrame, remove_duplicates: Optional[bool] = True
+):
+    """
+    Get coverage of the fragments of a chromosome.
+
+    Parameters
+    ---------
+    chromosome_fragments: pd.DataFrame
+            A data frame with 'Start', 'End', and 'Score' as columns, containing the fragments of one chromosome.
+    remove_duplicates: bool, optional
+            Whether duplicates should be removed before computing the coverage.
+
+    Return
+    ------
+    np.ndarray, np.ndarray, np.ndarray
+            Start positions, end positions and values of the coverage intervals.
+    """
+    # Collapse fragments found in several barcodes to one interval with the number of times it is found (or the
+    # sum of their scores), so coverage only needs to be computed from unique intervals.
+    intervals = chromosome_fragments.groupby(["Start", "End"], sort=False)
+    if remove_duplicates:
+        intervals = intervals.size()
+    else:
+        intervals = intervals["Score"].sum()
+    return get_coverage(
+        intervals.index.get_level_values("Start").to_numpy(),
+        intervals.index.get_level_values("End").to_numpy(),
+        intervals.to_numpy(),
+    )
+
+
+@ray.remote
+def get_chromosome_coverage_ray(
+    chromosome_fragments: pd.DataFrame, remove_duplicates: Optional[bool] = True
+):
+    """
+    Get coverage of the fragments of a chromosome.
+
+    Parameters
+    ---------
+    chromosome_fragments: pd.DataFrame
+            A data frame with 'Start', 'End', and 'Score' as columns, containing the fragments of one chromosome.
+    remove_duplicates: bool, optional
+            Whether duplicates should be removed before computing the coverage.
+
+    Return
+    ------
+    np.ndarray, np.ndarray, np.ndarray
+            Start positions, end positions and values of the coverage intervals.
+    """
+    return get_chromosome_coverage(chromosome_fragments, remove_duplicates)
+
+
+def coverage_to_bigwig(
+    bigwig_path: str,
+    header: List[Tuple[str, int]],
+    coverages: Iterable[Tuple[np.ndarray, np.ndarray, np.ndarray]],
+    multiplier: Optional[float] = 1.0,
+):
+    """
+    Write coverage per chromosome to a bigwig file.
+
+    Parameters
+    ---------
+    bigwig_path: str
+            Path to the bigwig file.
+    header: list
+            List of (chromosome, size) tuples for the bigwig header.
+    coverages: iterable
+            Start positions, end positions and values of the coverage intervals of each chromosome, in header order.
+    multiplier: float, optional
+            Value by which coverage values are multiplied. Default: 1.0.
+    """
+    bw = pyBigWig.open(bigwig_path, "w")
+    bw.addHeader(header)
+    for (chromosome, _), (starts, ends, values) in zip(header, coverages):
+        if len(starts) == 0:
+            continue
+        bw.addEntries(
+            [chromosome] * len(starts),
+            starts.tolist(),
+            ends=ends.tolist(),
+            # pyBigWig only accepts floats as values.
+            values=(values * multiplier).astype(np.float64).tolist(),
+        )
+    bw.close()
+
+
+@ray.remote
+def coverage_to_bigwig_ray(
+    bigwig_path: str,
+    header: List[Tuple[str, int]],
+    multiplier: float,
+    *coverages: Tuple[np.ndarray, np.ndarray, np.ndarray]
+):
+    """
+    Write coverage per chromosome to a bigwig file.
+
+    Parameters
+    ---------
+    bigwig_path: str
+            Path to the bigwig file.
+    header: list
+            List of (chromosome, size) tuples for the bigwig header.
+    multiplier: float
+            Value by which coverage values are multiplied.
+    *coverages
+            Start positions, end positions and values of the coverage intervals of each chromosome, in header order.
+
+    Return
+    ------
+    str
+            Path to the bigwig file.
+    """
+    coverage_to_bigwig(bigwig_path, header, coverages, multiplier)
+    return bigwig_path
+
+
+def fragments_to_bed(fragments_df: pd.DataFrame, bed_path: str):
+    """
+    Write fragments to a gzipped bed file.
+
+    Compression is done by bgzip (or pigz) in a separate process when available, which also makes the bed file
+    tabix indexable when bgzip is used.
+
+    Parameters
+    ---------
+    fragments_df: pd.DataFrame
+            A data frame with 'Chromosome', 'Start', 'End', 'Name', and 'Score' as columns.
+    bed_path: str
+            Path to the bed file.
+    """
+    bed_columns = ["Chromosome", "Start", "End", "Name", "Score", "Strand"]
+    bed_df = pd.DataFrame(
+        {
+            column: fragments_df[column] if column in fragments_df else "."
+            for column in bed_columns
+        }
+    )
+    if shutil.which("bgzip") is not None:
+        compress_cmd = ["bgzip", "-c"]
+    elif shutil.which("pigz") is not None:
+        compress_cmd = ["pigz", "-c"]
+    else:
+        bed_df.to_csv(
+            bed_path,
+            sep="\t",
+            header=False,
+            index=False,
+            compression="gzip",
+            quoting=csv.QUOTE_NONE,
+        )
+        return
+
+    with open(bed_path, "wb") as bed_fh:
+        compress_process = subprocess.Popen(
+            compress_cmd, stdin=subprocess.PIPE, stdout=bed_fh
+        )
+        with io.TextIOWrapper(compress_process.stdin) as compress_stdin:
+            bed_df.to_csv(
+                compress_stdin,
+                sep="\t",
+                header=False,
+                index=False,
+                quoting=csv.QUOTE_NONE,
             )
-        else:
-            group_pr.to_bigwig(
-                path=bigwig_path_group,
-                chromosome_sizes=chromsizes,
-                rpm=normalize_bigwig,
-                value_col="Score",
+        returncode = compress_process.wait()
+    if returncode != 0:
+        raise RuntimeError(
+            "command '{}' return with error (code {})".format(
+                " ".join(compress_cmd), returncode
             )
-    if isinstance(bed_path, str):
-        bed_path_group = os.path.join(bed_path, str(group) + ".bed.gz")
-        group_pr.to_bed(
-            path=bed_path_group, keep=False, compression="infer", chain=False
         )
 
-    log.info(str(group) + " done!")
+
+def get_coverage(
+    starts: np.ndarray, ends: np.ndarray, scores: Optional[np.ndarray] = None
+):
+    """
+    Get coverage of intervals on a chromosome as non-overlapping intervals with a constant non-zero value.
+
+    Parameters
+    ---------
+    starts: np.ndarray
+            Start positions of the intervals.
+    ends: np.ndarray
+            End positions of the intervals.
+    scores: np.ndarray, optional
+            Value of each interval. If None, each interval counts once.
+
+    Return
+    ------
+    np.ndarray, np.ndarray, np.ndarray
+            Start positions, end positions and values of the coverage intervals.
+    """
+    if scores is None:
+        scores = np.ones(len(starts), dtype=np.int64)
+    # Coverage increases by score at the start of an interval and decreases by score at its end.
+    positions = np.concatenate([starts, ends]).astype(np.int64)
+    deltas = np.concatenate([scores, -scores]).astype(np.int64)
+    order = np.argsort(positions, kind="stable")
+    positions = positions[order]
+    deltas = deltas[order]
+    breakpoints, first_idx = np.unique(positions, return_index=True)
+    if len(breakpoints) < 2:
+        # No intervals or only intervals with Start == End, so there is no coverage.
+        return (
+            np.array([], dtype=np.int64),
+            np.array([], dtype=np.int64),
+            np.array([], dtype=np.int64),
+        )
+    coverage = np.cumsum(np.add.reduceat(deltas, first_idx))[:-1]
+    # Merge consecutive intervals with the same coverage and remove intervals without coverage.
+    is_new_value = np.ones(len(coverage), dtype=bool)
+    is_new_value[1:] = coverage[1:] != coverage[:-1]
+    coverage_starts = breakpoints[:-1][is_new_value]
+    coverage_ends = np.append(coverage_starts[1:], breakpoints[-1])
+    coverage = coverage[is_new_value]
+    has_coverage = coverage != 0
+    return (
+        coverage_starts[has_coverage],
+        coverage_ends[has_coverage],
+        coverage[has_coverage],
+    )
 
 
 @ray.remote
 def export_pseudobulk_ray(
-    cell_data: pd.DataFrame,
+    group_fragments: pd.DataFrame,
     group: str,
-    fragments_df_dict: Dict[str, pd.DataFrame],
     chromsizes: pr.PyRanges,
-    bigwig_path: str,
-    bed_path: str,
-    sample_id_col: Optional[str] = "sample_id",
+    bigwig_path_group: Optional[str],
+    bed_path_group: Optional[str],
     normalize_bigwig: Optional[bool] = True,
     remove_duplicates: Optional[bool] = True,
-    split_pattern: Optional[str] = "___",
 ):
     """
-    Create pseudobulk as bed and bigwig from single cell fragments file given a barcode annotation and a group.
+    Create pseudobulk as bed and bigwig from the single cell fragments of a group.
 
     Parameters
     ---------
-    cell_data: pd.DataFrame
-            A cell metadata :class:`pd.Dataframe` containing barcodes, their annotation and their sample of origin.
+    group_fragments: pd.DataFrame
+            A data frame with 'Chromosome', 'Start', 'End', 'Name', and 'Score' as columns, containing the fragments of the cells
+            in the group. 'Score' indicates the number of times that a fragments is found assigned to that barcode.
     group: str
             A character string indicating the group for which pseudobulks will be created.
-    fragments_df_dict: dict
-            A dictionary containing data frames as values with 'Chromosome', 'Start', 'End', 'Name', and 'Score' as columns; and sample label
-            as keys. 'Score' indicates the number of times that a fragments is found assigned to that barcode.
     chromsizes: pr.PyRanges
             A :class:`pr.PyRanges` containing size of each column, containing 'Chromosome', 'Start' and 'End' columns.
-    bed_path: str
-            Path to folder where the fragments bed file will be saved.
-    bigwig_path: str
-            Path to folder where the bigwig file will be saved.
-    sample_id_col: str, optional
-            Name of the column containing the sample name per barcode in the input :class:`CistopicObject.cell_data` or class:`pd.DataFrame`. Default: 'sample_id'.
+    bigwig_path_group: str
+            Path to the bigwig file of the group. If None, the file will not be generated.
+    bed_path_group: str
+            Path to the fragments bed file of the group. If None, the file will not be generated.
     normalize_bigwig: bool, optional
             Whether bigwig files should be CPM normalized. Default: True.
     remove_duplicates: bool, optional
             Whether duplicates should be removed before converting the data to bigwig.
-    split_pattern: str
-            Pattern to split cell barcode from sample id. Default: ___ .
+
+    Return
+    ------
+    tuple
+            The group, the path to its bigwig file and the path to its fragments bed file (None if not generated).
     """
-    export_pseudobulk_one_sample(
-        cell_data,
+    _configure_logging()
+    return export_pseudobulk_one_sample(
+        group_fragments,
         group,
-        fragments_df_dict,
         chromsizes,
-        bigwig_path,
-        bed_path,
-        sample_id_col,
+        bigwig_path_group,
+        bed_path_group,
         normalize_bigwig,
         remove_duplicates,
-        split_pattern,
     )
 
 
@@ -398,134 +866,50 @@ def peak_calling(
             Whether to keep duplicate tags at te exact same location. Default: 'all'.
     q_value: float, optional
             The q-value (minimum FDR) cutoff to call significant regions. Default: 0.05.
+    nolambda: bool, optional
+            Do not consider the local bias/lambda at peak candidate regions.
     **kwargs
-            Additional parameters to pass to ray.init().
+            Ignored. Kept for backwards compatibility, as peaks are no longer called with ray.
 
     Return
     ------
     dict
             A dictionary containing each group label as names and :class:`pr.PyRanges` with MACS2 narrow peaks as values.
     """
-    if not os.path.exists(outdir):
-        os.makedirs(outdir)
+    _configure_logging()
 
-    if n_cpu > 1:
-        ray.init(num_cpus=n_cpu, **kwargs)
-        narrow_peaks = ray.get(
-            [
-                macs_call_peak_ray.remote(
-                    macs_path,
-                    bed_paths[name],
-                    name,
-                    outdir,
-                    genome_size,
-                    input_format,
-                    shift,
-                    ext_size,
-                    keep_dup,
-                    q_value,
-                    nolambda,
-                )
-                for name in list(bed_paths.keys())
-            ]
-        )
-        ray.shutdown()
-    else:
-        narrow_peaks = [macs_call_peak(
-                    macs_path,
-                    bed_paths[name],
-                    name,
-                    outdir,
-                    genome_size,
-                    input_format,
-                    shift,
-                    ext_size,
-                    keep_dup,
-                    q_value,
-                    nolambda,
-                )
-                for name in list(bed_paths.keys())
-            ]
+    os.makedirs(outdir, exist_ok=True)
+
+    # MACS2 runs in a subprocess, so threads are enough to call peaks for several groups at the same time.
+    with ThreadPoolExecutor(max_workers=n_cpu) as executor:
+        narrow_peaks_futures = [
+            executor.submit(
+                macs_call_peak,
+                macs_path,
+                bed_paths[name],
+                name,
+                outdir,
+                genome_size,
+                input_format,
+                shift,
+                ext_size,
+                keep_dup,
+                q_value,
+                nolambda,
+            )
+            for name in bed_paths.keys()
+        ]
+        narrow_peaks = [
+            narrow_peaks_future.result() for narrow_peaks_future in narrow_peaks_futures
+        ]
     narrow_peaks_dict = {
-        list(bed_paths.keys())[i]: narrow_peaks[i].narrow_peak
-        for i in range(len(narrow_peaks))
+        name: narrow_peak.narrow_peak
+        for name, narrow_peak in zip(bed_paths.keys(), narrow_peaks)
     }
     return narrow_peaks_dict
 
-def macs_call_peak(
-    macs_path: str,
-    bed_path: str,
-    name: str,
-    outdir: str,
-    genome_size: str,
-    input_format: Optional[str] = "BEDPE",
-    shift: Optional[int] = 73,
-    ext_size: Optional[int] = 146,
-    keep_dup: Optional[str] = "all",
-    q_value: Optional[int] = 0.05,
-    nolambda: Optional[bool] = True,
-):
-    """
-    Performs pseudobulk peak calling with MACS2 in a group. It requires to have MACS2 installed (https://github.com/macs3-project/MACS).
-
-    Parameters
-    ---------
-    macs_path: str
-            Path to MACS binary (e.g. /xxx/MACS/xxx/bin/macs2).
-    bed_path: str
-            Path to fragments file bed file.
-    name: str
-            Name of string of the group.
-    outdir: str
-            Path to the output directory.
-    genome_size: str
-            Effective genome size which is defined as the genome size which can be sequenced. Possible values: 'hs', 'mm', 'ce' and 'dm'.
-    input_format: str, optional
-            Format of tag file can be ELAND, BED, ELANDMULTI, ELANDEXPORT, SAM, BAM, BOWTIE, BAMPE, or BEDPE. Default is AUTO which will
-            allow MACS to decide the format automatically. Default: 'BEDPE'.
-    shift: int, optional
-            To set an arbitrary shift in bp. For finding enriched cutting sites (such as in ATAC-seq) a shift of 73 bp is recommended.
-            Default: 73.
-    ext_size: int, optional
-            To extend reads in 5'->3' direction to fix-sized fragment. For ATAC-seq data, a extension of 146 bp is recommended.
-            Default: 146.
-    keep_dup: str, optional
-            Whether to keep duplicate tags at te exact same location. Default: 'all'.
-    q_value: float, optional
-            The q-value (minimum FDR) cutoff to call significant regions. Default: 0.05.
-    nolambda: bool, optional
-            Do not consider the local bias/lambda at peak candidate regions.
-
-    Return
-    ------
-    dict
-            A :class:`pr.PyRanges` with MACS2 narrow peaks as values.
-    """
-    # Create logger
-    level = logging.INFO
-    log_format = "%(asctime)s %(name)-12s %(levelname)-8s %(message)s"
-    handlers = [logging.StreamHandler(stream=sys.stdout)]
-    logging.basicConfig(level=level, format=log_format, handlers=handlers)
-    log = logging.getLogger("cisTopic")
 
-    MACS_peak_calling = MACSCallPeak(
-        macs_path,
-        bed_path,
-        name,
-        outdir,
-        genome_size,
-        input_format=input_format,
-        shift=shift,
-        ext_size=ext_size,
-        keep_dup=keep_dup,
-        q_value=q_value,
-        nolambda=nolambda,
-    )
-    log.info(name + " done!")
-    return MACS_peak_calling
-
-@ray.remote
-def macs_call_peak_ray(
+def macs_call_peak(
     macs_path: str,
     bed_path: str,
     name: str,
@@ -574,13 +958,6 @@ def macs_call_peak_ray(
     dict
             A :class:`pr.PyRanges` with MACS2 narrow peaks as values.
     """
-    # Create logger
-    level = logging.INFO
-    log_format = "%(asctime)s %(name)-12s %(levelname)-8s %(message)s"
-    handlers = [logging.StreamHandler(stream=sys.stdout)]
-    logging.basicConfig(level=level, format=log_format, handlers=handlers)
-    log = logging.getLogger("cisTopic")
-
     MACS_peak_calling = MACSCallPeak(
         macs_path,
         bed_path,
@@ -660,13 +1037,6 @@ class MACSCallPeak:
         """
         Run MACS2 peak calling.
         """
-        # Create logger
-        level = logging.INFO
-        log_format = "%(asctime)s %(name)-12s %(levelname)-8s %(message)s"
-        handlers = [logging.StreamHandler(stream=sys.stdout)]
-        logging.basicConfig(level=level, format=log_format, handlers=handlers)
-        log = logging.getLogger("cisTopic")
-
         if self.nolambda is True:
             cmd = (
                 self.macs_path
@@ -706,22 +1076,48 @@ class MACSCallPeak:
         """
         Load MACS2 narrow peak files as :class:`pr.PyRanges`.
         """
-        narrow_peak = pd.read_csv(
-            os.path.join(self.outdir, self.name + "_peaks.narrowPeak"),
-            sep="\t",
-            header=None,
+        import polars as pl
+
+        # Read narrow peak file with the multithreaded pyarrow CSV reader and use compact column types.
+        narrow_peak = (
+            pl.read_csv(
+                os.path.join(self.outdir, self.name + "_peaks.narrowPeak"),
+                has_headers=False,
+                sep="\t",
+                use_pyarrow=True,
+                new_columns=[
+                    "Chromosome",
+                    "Start",
+                    "End",
+                    "Name",
+                    "Score",
+                    "Strand",
+                    "FC_summit",
+                    "-log10_pval",
+                    "-log10_qval",
+                    "Summit",
+                ],
+            )
+            .with_columns(
+                [
+                    pl.col("Chromosome").cast(pl.Utf8).cast(pl.Categorical),
+                    pl.col("Start").cast(pl.Int32),
+                    pl.col("End").cast(pl.Int32),
+                    pl.col("Name").cast(pl.Utf8),
+                    pl.col("Score").cast(pl.Int64),
+                    pl.col("Strand").cast(pl.Utf8),
+                    pl.col("FC_summit").cast(pl.Float32),
+                    pl.col("-log10_pval").cast(pl.Float32),
+                    pl.col("-log10_qval").cast(pl.Float32),
+                    pl.col("Summit").cast(pl.Int32),
+                ]
+            )
+            .to_pandas()
         )
-        narrow_peak.columns = [
-            "Chromosome",
-            "Start",
-            "End",
-            "Name",
-            "Score",
-            "Strand",
-            "FC_summit",
-            "-log10_pval",
-            "-log10_qval",
-            "Summit",
-        ]
         narrow_peak_pr = pr.PyRanges(narrow_peak)
+        # PyRanges (>= 0.1) casts Start and End to int64, so cast them back to int32 for each chromosome.
+        for key, chromosome_df in narrow_peak_pr.dfs.items():
+            narrow_peak_pr.dfs[key] = chromosome_df.astype(
+                {"Start": np.int32, "End": np.int32}
+            )
         return narrow_peak_pr
@@ -179,24 +179,25 @@ def load_cisTopic_model(path_to_cisTopic_model_matrices):
 
 
 def prepare_tag_cells(cell_names, split_pattern="___"):
+    # Use vectorized pandas string operations instead of looping over each cell name in Python.
+    cell_names = pd.Series(cell_names, dtype=str)
     if split_pattern == "-":
-        new_cell_names = [
-            re.findall(r"^[ACGT]*-[0-9]+-", x)[0].rstrip("-")
-            if len(re.findall(r"^[ACGT]*-[0-9]+-", x)) != 0
-            else x
-            for x in cell_names
-        ]
-        new_cell_names = [
-            re.findall(r"^\w*-[0-9]*", new_cell_names[i])[0].rstrip("-")
-            if (len(re.findall(r"^\w*-[0-9]*", new_cell_names[i])) != 0)
-            & (new_cell_names[i] == cell_names[i])
-            else new_cell_names[i]
-            for i in range(len(new_cell_names))
-        ]
+        # Keep barcode and GEM well (e.g. ATGCTGTGCG-1 from ATGCTGTGCG-1-Sample_1).
+        new_cell_names = cell_names.str.extract(r"^([ACGT]*-[0-9]+)-", expand=False)
+        # Cell names not matching the previous pattern are stripped at the first "-" followed by digits.
+        # Only those cell names are matched against the second pattern.
+        not_matched = new_cell_names.isna()
+        if not_matched.any():
+            new_cell_names[not_matched] = (
+                cell_names[not_matched]
+                .str.extract(r"^(\w*-[0-9]*)", expand=False)
+                .str.rstrip("-")
+            )
+            new_cell_names = new_cell_names.fillna(cell_names)
     else:
-        new_cell_names = [x.split(split_pattern)[0] for x in cell_names]
+        new_cell_names = cell_names.str.partition(split_pattern, expand=False).str[0]
 
-    return new_cell_names
+    return new_cell_names.tolist()
 
 
 def multiplot_from_generator(
@@ -331,7 +332,10 @@ def get_tss_matrix(fragments, flank_window, tss_space_annotation):
 
 
 def read_fragments_from_file(
-    fragments_bed_filename, use_polars: bool = True
+    fragments_bed_filename,
+    use_polars: bool = True,
+    cell_barcodes=None,
+    chunk_size: int = 10_000_000,
 ) -> pr.PyRanges:
     """
     Read fragments BED file to PyRanges object.
@@ -340,6 +344,11 @@ def read_fragments_from_file(
     ----------
     fragments_bed_filename: Fragments BED filename.
     use_polars: Use polars instead of pandas for reading the fragments BED file.
+    cell_barcodes: Only keep fragments of these cell barcodes. Fragments of other barcodes are
+        discarded while reading (read in chunks with pandas or lazily scanned with polars), so the
+        full fragments file is never loaded in memory. Polars can not scan gzipped fragments files,
+        so those are fully read before filtering them.
+    chunk_size: Number of lines to read at once when filtering on cell barcodes with pandas.
 
     Returns
     -------
@@ -390,47 +399,94 @@ def read_fragments_from_file(
     if use_polars:
         import polars as pl
 
-        # Read fragments BED file with polars.
-        df = (
-            pl.read_csv(
+        if fragments_bed_filename.endswith(".gz"):
+            # polars can not scan compressed files, so read the full fragments BED file first.
+            df = pl.read_csv(
                 fragments_bed_filename,
                 has_headers=False,
                 skip_rows=skip_rows,
                 sep="\t",
                 use_pyarrow=True,
                 new_columns=bed_column_names[:nbr_columns],
+            ).lazy()
+        else:
+            # Scan fragments BED file lazily with polars, so fragments of other cell barcodes are discarded while
+            # reading, instead of after loading the full fragments file.
+            df = pl.scan_csv(
+                fragments_bed_filename,
+                has_headers=False,
+                skip_rows=skip_rows,
+                sep="\t",
+                with_column_names=lambda column_names: list(
+                    bed_column_names[: len(column_names)]
+                ),
             )
-            .with_columns(
+
+        if cell_barcodes is not None:
+            # Only keep fragments of the requested cell barcodes.
+            df = df.filter(pl.col("Name").is_in(list(cell_barcodes)))
+
+        # Convert "Chromosome" and "Name" column to pd.Categorical as groupby operations will be done on it later.
+        # Casting them to categoricals in polars, makes them dictionary encoded Arrow arrays, so they are converted to
+        # pd.Categorical directly, instead of creating a Python string object for each fragment first.
+        df = (
+            df.with_columns(
                 [
                     pl.col("Chromosome").cast(pl.Utf8),
                     pl.col("Start").cast(pl.Int32),
                     pl.col("End").cast(pl.Int32),
                     pl.col("Name").cast(pl.Utf8),
                 ]
+                + ([pl.col("Score").cast(pl.Int32)] if nbr_columns > 4 else [])
             )
+            .with_columns(
+                [
+                    pl.col("Chromosome").cast(pl.Categorical),
+                    pl.col("Name").cast(pl.Categorical),
+                ]
+            )
+            .collect()
             .to_pandas()
         )
-
-        # Convert "Name" column to pd.Categorical as groupby operations will be done on it later.
-        df["Name"] = df["Name"].astype("category")
     else:
-        # Read fragments BED file with pandas.
-        df = pd.read_table(
-            fragments_bed_filename,
-            sep="\t",
-            skiprows=skip_rows,
-            header=None,
-            names=bed_column_names[:nbr_columns],
-            doublequote=False,
-            engine="c",
-            dtype={
+        read_table_kwargs = {
+            "sep": "\t",
+            "skiprows": skip_rows,
+            "header": None,
+            "names": bed_column_names[:nbr_columns],
+            "doublequote": False,
+            "engine": "c",
+            "dtype": {
                 "Chromosome": str,
-                "Start'": np.int32,
+                "Start": np.int32,
                 "End": np.int32,
                 "Name": "category",
+                "Score": np.int32,
                 "Strand": str,
             },
-        )
+        }
+
+        if cell_barcodes is None:
+            # Read fragments BED file with pandas.
+            df = pd.read_table(fragments_bed_filename, **read_table_kwargs)
+        else:
+            # Stream fragments BED file with pandas and only keep fragments of the requested cell barcodes,
+            # so the full fragments file never needs to fit in memory.
+            # As "Name" is read as pd.Categorical, isin only needs to look up the barcodes in the categories
+            # of each chunk and compare integer codes, instead of hashing each barcode string.
+            cell_barcodes = pd.Index(cell_barcodes)
+            df = pd.concat(
+                [
+                    chunk.loc[chunk["Name"].isin(cell_barcodes)]
+                    for chunk in pd.read_table(
+                        fragments_bed_filename,
+                        chunksize=chunk_size,
+                        **read_table_kwargs,
+                    )
+                ],
+                ignore_index=True,
+            )
+            df["Name"] = df["Name"].astype("category")
 
     # Convert pandas dataframe to PyRanges dataframe.
     # This will convert "Chromosome" and "Strand" columns to pd.Categorical.
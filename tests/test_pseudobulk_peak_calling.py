@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+import pyBigWig
+import pyranges as pr
+import pytest
+
+from pycisTopic.pseudobulk_peak_calling import fragments_to_bigwig, get_coverage
+
+
+@pytest.fixture
+def fragments_df():
+    rng = np.random.default_rng(0)
+    n_fragments = 2000
+    starts = rng.integers(0, 5000, n_fragments)
+    fragments_df = pd.DataFrame(
+        {
+            "Chromosome": pd.Categorical(
+                rng.choice(["chr1", "chr2", "chrX"], n_fragments),
+                categories=["chr1", "chr2", "chrX", "chrY"],
+            ),
+            "Start": starts.astype(np.int32),
+            "End": (starts + rng.integers(1, 300, n_fragments)).astype(np.int32),
+            "Name": rng.choice(["AAAA-1", "CCCC-1", "GGGG-1"], n_fragments),
+            "Score": rng.integers(1, 5, n_fragments).astype(np.int32),
+        }
+    )
+    # Add duplicated fragments.
+    return pd.concat([fragments_df, fragments_df.iloc[:100]], ignore_index=True)
+
+
+@pytest.fixture
+def chromsizes():
+    return pr.PyRanges(
+        pd.DataFrame(
+            {
+                "Chromosome": ["chr1", "chr2", "chrX", "chrY"],
+                "Start": 0,
+                "End": 10000,
+            }
+        )
+    )
+
+
+def test_get_coverage():
+    starts = np.array([0, 5, 5, 20])
+    ends = np.array([10, 10, 15, 20])
+    scores = np.array([1, 2, 1, 3])
+
+    coverage_starts, coverage_ends, coverage = get_coverage(starts, ends, scores)
+
+    np.testing.assert_array_equal(coverage_starts, [0, 5, 10])
+    np.testing.assert_array_equal(coverage_ends, [5, 10, 15])
+    np.testing.assert_array_equal(coverage, [1, 4, 1])
+
+
+def test_get_coverage_no_coverage():
+    for starts, ends in [([], []), ([5, 5], [5, 5])]:
+        coverage_starts, coverage_ends, coverage = get_coverage(
+            np.array(starts, dtype=np.int32), np.array(ends, dtype=np.int32)
+        )
+        assert len(coverage_starts) == len(coverage_ends) == len(coverage) == 0
+
+
+@pytest.mark.parametrize("normalize_bigwig", [True, False])
+@pytest.mark.parametrize("remove_duplicates", [True, False])
+def test_fragments_to_bigwig_matches_pyranges(
+    tmp_path, fragments_df, chromsizes, normalize_bigwig, remove_duplicates
+):
+    bigwig_path = str(tmp_path / "fragments.bw")
+    expected_bigwig_path = str(tmp_path / "expected.bw")
+
+    fragments_to_bigwig(
+        fragments_df, chromsizes, bigwig_path, normalize_bigwig, remove_duplicates
+    )
+    pr.PyRanges(fragments_df.astype({"Chromosome": str})).to_bigwig(
+        path=expected_bigwig_path,
+        chromosome_sizes=chromsizes,
+        rpm=normalize_bigwig,
+        value_col=None if remove_duplicates else "Score",
+    )
+
+    bw = pyBigWig.open(bigwig_path)
+    expected_bw = pyBigWig.open(expected_bigwig_path)
+    for chromosome in ["chr1", "chr2", "chrX"]:
+        intervals = np.array(bw.intervals(chromosome))
+        expected_intervals = np.array(expected_bw.intervals(chromosome))
+        np.testing.assert_array_equal(intervals[:, :2], expected_intervals[:, :2])
+        np.testing.assert_allclose(intervals[:, 2], expected_intervals[:, 2], rtol=1e-6)
+    bw.close()
+    expected_bw.close()
@@ -0,0 +1,50 @@
+import gzip
+
+import pandas as pd
+import pytest
+
+from pycisTopic.utils import read_fragments_from_file
+
+
+@pytest.fixture
+def fragments_bed_filename(tmp_path):
+    fragments_bed_filename = str(tmp_path / "fragments.tsv.gz")
+    with gzip.open(fragments_bed_filename, "wt") as fragments_bed_fh:
+        fragments_bed_fh.write("# comment\n")
+        for i in range(1000):
+            fragments_bed_fh.write(
+                f"chr{i % 3 + 1}\t{i * 10}\t{i * 10 + 50}\tBARCODE{i % 7}-1\t{i % 4 + 1}\n"
+            )
+    return fragments_bed_filename
+
+
+@pytest.mark.parametrize("use_polars", [True, False])
+def test_read_fragments_from_file_cell_barcodes(fragments_bed_filename, use_polars):
+    cell_barcodes = ["BARCODE1-1", "BARCODE3-1"]
+
+    fragments_df = read_fragments_from_file(
+        fragments_bed_filename, use_polars=use_polars, cell_barcodes=cell_barcodes
+    ).df
+    expected_fragments_df = pd.read_table(
+        fragments_bed_filename,
+        comment="#",
+        header=None,
+        names=["Chromosome", "Start", "End", "Name", "Score"],
+    )
+    expected_fragments_df = expected_fragments_df[
+        expected_fragments_df["Name"].isin(cell_barcodes)
+    ]
+
+    def sort_fragments(df):
+        return (
+            df.astype({"Chromosome": str, "Name": str})
+            .sort_values(["Chromosome", "Start", "Name"])
+            .reset_index(drop=True)
+        )
+
+    assert set(fragments_df["Name"]) == set(cell_barcodes)
+    pd.testing.assert_frame_equal(
+        sort_fragments(fragments_df),
+        sort_fragments(expected_fragments_df),
+        check_dtype=False,
+    )